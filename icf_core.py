@@ -0,0 +1,326 @@
+# Shared loaders and report generation for the ICF-check Streamlit app
+
+import pandas as pd
+import numpy as np
+from docx import Document
+from docx.table import _Cell
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from io import BytesIO
+from copy import deepcopy
+from datetime import datetime
+from pandas.api.types import is_datetime64_any_dtype, is_numeric_dtype
+
+try:
+    import python_calamine  # noqa: F401
+    FAST_EXCEL_ENGINE = "calamine"
+except ImportError:
+    FAST_EXCEL_ENGINE = None
+
+# ==========================
+# Study Mapping
+# ==========================
+
+MEANING_TO_INTERNAL = {
+    "patientenid": "mnpaid",
+    "icf datum unterschrift": "icdat",
+    "eos datum": "eosdat",
+    "todesdatum": "dthdat",
+    "patient eligible": "eligyn",
+    "randomisierungsgruppe": "mnp_rando_gr",
+    "randomisierungsgruppe2": "mnp_rando_v6_gr"
+}
+
+def get_mapping_for_study(mapping_df, study):
+    meanings = mapping_df.iloc[:, 0].astype(str).str.strip().str.lower()
+    codes = mapping_df[study]
+    return {
+        MEANING_TO_INTERNAL[meaning]: str(code)
+        for meaning, code in zip(meanings, codes)
+        if meaning in MEANING_TO_INTERNAL and pd.notna(code)
+    }
+
+# ==========================
+# Helper Loader
+# ==========================
+
+def excel_engine(file):
+    # calamine (Rust) reads xlsx and xls much faster than openpyxl/xlrd
+    if FAST_EXCEL_ENGINE:
+        return FAST_EXCEL_ENGINE
+    name = str(getattr(file, "name", file)).lower()
+    return "openpyxl" if name.endswith(".xlsx") else None
+
+TEXT_COLUMNS = ["mnpaid", "eligyn", "mnp_rando_gr", "mnp_rando_v6_gr"]
+
+def text_dtypes(column_map):
+    # only ID/text columns are forced to str, date columns keep the
+    # native datetime type coming from Excel
+    return {column_map[k]: str for k in TEXT_COLUMNS if k in column_map}
+
+def normalize_columns(df, column_map):
+    rename_dict = {v: k for k, v in column_map.items() if v in df.columns}
+    return df.rename(columns=rename_dict)
+
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d.%m.%Y", "%d.%m.%y", "%m/%d/%Y"]
+
+def guess_date_format(values):
+    sample = values.dropna()
+    if sample.empty:
+        return None
+    first = str(sample.iloc[0]).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            datetime.strptime(first, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+def excel_serial_dates(values):
+    # cells in "General" format hold the Excel day number, e.g. 44097
+    return pd.to_datetime(values, unit="D", origin="1899-12-30", errors="coerce")
+
+def parse_dates(values):
+    if values is None:
+        return pd.NaT
+    if is_datetime64_any_dtype(values):
+        return values
+    if is_numeric_dtype(values):
+        return excel_serial_dates(values.astype(float))
+
+    # numeric cells in a mixed column are serial days, numeric-looking text
+    # ("44097" typed as text) stays text
+    try:
+        is_text = values.str.len().notna()
+    except AttributeError:  # column without any strings
+        is_text = pd.Series(False, index=values.index)
+    serial = pd.to_numeric(values.where(~is_text), errors="coerce").notna()
+    text = values.where(~serial)
+
+    # Excel exports share one date format per column, so parse with the
+    # format of the first value and only fall back for the leftovers
+    parsed = pd.to_datetime(text, errors="coerce", format=guess_date_format(text), cache=True)
+
+    # leftovers (e.g. dd.mm.yyyy text next to native Excel dates) are tried
+    # against the known formats first and only then parsed day-first, so
+    # German dates are never read month-first
+    for fmt in DATE_FORMATS:
+        leftover = parsed.isna() & text.notna()
+        if not leftover.any():
+            break
+        parsed[leftover] = pd.to_datetime(text[leftover], errors="coerce", format=fmt, cache=True)
+
+    leftover = parsed.isna() & text.notna()
+    if leftover.any():
+        parsed[leftover] = pd.to_datetime(text[leftover], errors="coerce", dayfirst=True, cache=True)
+    if serial.any():
+        parsed[serial] = excel_serial_dates(values[serial].astype(float))
+    return parsed
+
+def load_icf_versions(file_bytes, file_name):
+    xls = pd.ExcelFile(BytesIO(file_bytes), engine=excel_engine(file_name))
+    sheet = "ICF2" if "ICF2" in xls.sheet_names else xls.sheet_names[0]
+    df = pd.read_excel(xls, sheet_name=sheet)
+
+    df = df.rename(columns={
+        c: "ICF Version" for c in df.columns if "version" in c.lower()
+    })
+    df = df.rename(columns={
+        c: "Gültig ab" for c in df.columns if "gültig" in c.lower() or "valid" in c.lower()
+    })
+
+    df["Gültig ab"] = parse_dates(df["Gültig ab"])
+    return df.sort_values("Gültig ab").reset_index(drop=True)
+
+def read_upload(file_bytes, file_name, column_map):
+    df = pd.read_excel(
+        BytesIO(file_bytes), dtype=text_dtypes(column_map), engine=excel_engine(file_name)
+    )
+    df = normalize_columns(df, column_map)
+    # patient IDs repeat a lot and are the groupby/merge key everywhere
+    if "mnpaid" in df.columns:
+        df["mnpaid"] = df["mnpaid"].astype("category")
+    return df
+
+def load_consents(file_bytes, file_name, column_map):
+    df = read_upload(file_bytes, file_name, column_map)
+    df["icdat"] = parse_dates(df.get("icdat"))
+    return df
+
+def load_eos(file_bytes, file_name, column_map):
+    df = read_upload(file_bytes, file_name, column_map)
+    df["eosdat"] = parse_dates(df.get("eosdat"))
+    df["dthdat"] = parse_dates(df.get("dthdat"))
+    return df
+
+def load_elig(file_bytes, file_name, column_map):
+    return read_upload(file_bytes, file_name, column_map)
+
+# ==========================
+# Word Helpers
+# ==========================
+
+def set_run_text(t, text):
+    # same result as cell.text: line breaks become <w:br/>
+    lines = str(text).split("\n")
+    t.text = lines[0]
+    run = t.getparent()
+    for line in lines[1:]:
+        run.append(OxmlElement("w:br"))
+        next_t = OxmlElement("w:t")
+        next_t.text = line
+        run.append(next_t)
+    for el in run.iter(qn("w:t")):
+        if el.text and el.text != el.text.strip():
+            el.set(qn("xml:space"), "preserve")
+
+def append_table_rows(table, values):
+    # build one template row through python-docx and clone its XML for
+    # every report row instead of add_row() + cell.text per cell
+    row = table.add_row()
+    for cell in row.cells:
+        cell.text = "-"
+    template = row._tr
+    tbl = table._tbl
+    tbl.remove(template)
+
+    for row_values in values:
+        tr = deepcopy(template)
+        for t, text in zip(list(tr.iter(qn("w:t"))), row_values):
+            set_run_text(t, text)
+        tbl.append(tr)
+
+# ==========================
+# Core Logic
+# ==========================
+
+def generate_report(icf_df, consents_df, eos_df, elig_df, output, include_na=True):
+    # sorted once by patient and date; all groupbys below reuse that order
+    consents_df = consents_df[consents_df["mnpaid"].notna()].sort_values(
+        ["mnpaid", "icdat"], kind="stable"
+    )
+
+    # one row per patient: randomisation of the first consent, last consent,
+    # EOS/death and eligibility (last entry per patient wins, as before)
+    patients = (
+        consents_df.drop_duplicates("mnpaid")
+        .reindex(columns=["mnpaid", "mnp_rando_gr", "mnp_rando_v6_gr"], fill_value="-")
+        .merge(
+            consents_df.groupby("mnpaid", sort=False, observed=True)["icdat"].max()
+            .rename("last_consent").reset_index(),
+            on="mnpaid"
+        )
+        .merge(
+            eos_df[["mnpaid", "eosdat", "dthdat"]].drop_duplicates("mnpaid", keep="last"),
+            on="mnpaid", how="left"
+        )
+        .merge(
+            elig_df[["mnpaid", "eligyn"]].drop_duplicates("mnpaid", keep="last"),
+            on="mnpaid", how="left"
+        )
+    )
+    patients["screening_failure"] = patients["eligyn"].fillna("yes").str.lower().eq("no")
+
+    rando_text = [
+        f"{r1} / {r2}" for r1, r2 in zip(patients["mnp_rando_gr"], patients["mnp_rando_v6_gr"])
+    ]
+    eos_text = (
+        ("EOS (Death, " + patients["dthdat"].dt.strftime("%d.%m.%Y") + ")")
+        .fillna("EOS (" + patients["eosdat"].dt.strftime("%d.%m.%Y") + ")")
+        .fillna("")
+    )
+    patients["comment"] = np.where(
+        patients["screening_failure"],
+        "Screening Failure",
+        ["\n".join(filter(None, texts)) for texts in zip(rando_text, eos_text)]
+    )
+
+    # many patients sign on the same day: look up each date only once.
+    # merge_asof finds the latest "Gültig ab" on or before each date, the
+    # second merge expands it to all versions with that same "Gültig ab"
+    consent_dates = consents_df[["icdat"]].dropna().drop_duplicates().sort_values("icdat")
+    icf_dates = icf_df[["Gültig ab", "ICF Version"]].astype(
+        {"Gültig ab": consent_dates["icdat"].dtype}
+    )
+    valid_dates = icf_dates[["Gültig ab"]].dropna().drop_duplicates().sort_values("Gültig ab")
+    versions_by_date = (
+        pd.merge_asof(
+            consent_dates, valid_dates,
+            left_on="icdat", right_on="Gültig ab", direction="backward"
+        )
+        .dropna(subset=["Gültig ab"])
+        .merge(icf_dates, on="Gültig ab")
+        .rename(columns={"ICF Version": "icf_version"})[["icdat", "icf_version"]]
+    )
+
+    # latest consent date per patient and signed version
+    signed = (
+        consents_df[["mnpaid", "icdat"]]
+        .merge(versions_by_date, on="icdat")
+        .groupby(["mnpaid", "icf_version"], sort=False, observed=True)["icdat"].max()
+        .dt.strftime("%Y-%m-%d")
+        .rename("signed")
+    )
+
+    # every patient against every ICF version
+    report = (
+        patients.merge(icf_df[["ICF Version", "Gültig ab"]], how="cross")
+        .merge(signed, left_on=["mnpaid", "ICF Version"], right_index=True, how="left")
+    )
+
+    check = (
+        ~report["screening_failure"]
+        & (report["Gültig ab"] > report["last_consent"])
+        & (report["eosdat"].isna() | (report["eosdat"] >= report["Gültig ab"]))
+    )
+    report["Date"] = report["signed"].where(
+        report["signed"].notna(), np.where(check, "CHECK", "n.a.")
+    )
+
+    if not include_na:
+        # drop versions that never applied to the patient, but keep one
+        # row for patients that would otherwise vanish from the report
+        applies = report["Date"] != "n.a."
+        has_entry = applies.groupby(report["mnpaid"], sort=False, observed=True).transform("any")
+        report = report[applies | (~has_entry & ~report["mnpaid"].duplicated())]
+
+    # Patient-ID, Version, Date, Comment
+    rows = report[["mnpaid", "ICF Version", "Date", "comment"]]
+
+    # Word
+    doc = Document()
+    table = doc.add_table(rows=1, cols=4)
+    hdr = table.rows[0].cells
+    hdr[0].text = "Patient-ID"
+    hdr[1].text = "Version of Informed Consent Form"
+    hdr[2].text = "Date of Consent"
+    hdr[3].text = "Comment (e.g. issues/findings noted, Screening Failure, reason for EOS, TR participation etc.)"
+
+
+    append_table_rows(table, rows.itertuples(index=False, name=None))
+
+    # --- Merge cells for Patient-ID and Comment ---
+    # the rows of each patient are consecutive in the report, so the runs
+    # come from the DataFrame instead of reading the cell texts back
+    pids = rows["mnpaid"].to_numpy()
+    run_start = np.ones(len(pids), dtype=bool)
+    run_start[1:] = pids[1:] != pids[:-1]
+    starts = np.flatnonzero(run_start)
+    lengths = np.diff(np.append(starts, len(pids)))
+    comments = rows["comment"].to_numpy()
+
+    table_rows = table._tbl.tr_lst[1:]  # skip header
+    for start, length in zip(starts, lengths):
+        if length < 2:
+            continue
+
+        end = start + length - 1
+        for col, text in ((0, pids[start]), (3, comments[start])):
+            top = _Cell(table_rows[start].tc_lst[col], table)
+            merged = top.merge(_Cell(table_rows[end].tc_lst[col], table))
+            merged.text = text
+
+    # output is a path or a writable file object; writing straight to a
+    # file avoids holding the report in a BytesIO next to the UI's copy
+    doc.save(output)
@@ -0,0 +1,52 @@
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+from docx import Document
+
+from icf_core import generate_report, parse_dates
+
+
+def test_parse_dates_mixed_native_and_german_text():
+    values = pd.Series([datetime(2023, 1, 2), "05.01.2023", "25.01.2023", None], dtype=object)
+
+    parsed = parse_dates(values)
+
+    assert parsed[0] == pd.Timestamp("2023-01-02")
+    assert parsed[1] == pd.Timestamp("2023-01-05")
+    assert parsed[2] == pd.Timestamp("2023-01-25")
+    assert pd.isna(parsed[3])
+
+
+def test_parse_dates_excel_serial_numbers():
+    values = pd.Series([44097, datetime(2021, 1, 1), "44097", None], dtype=object)
+
+    parsed = parse_dates(values)
+
+    assert parsed[0] == pd.Timestamp("2020-09-23")
+    assert parsed[1] == pd.Timestamp("2021-01-01")
+    assert pd.isna(parsed[2])
+    assert pd.isna(parsed[3])
+    assert parse_dates(pd.Series([44097, None]))[0] == pd.Timestamp("2020-09-23")
+
+
+def test_generate_report_with_unsorted_icf_versions():
+    icf_df = pd.DataFrame({
+        "ICF Version": ["V2", "V1"],
+        "Gültig ab": pd.to_datetime(["2021-01-01", "2020-01-01"]),
+    })
+    consents_df = pd.DataFrame({
+        "mnpaid": ["P1", "P1"],
+        "icdat": pd.to_datetime(["2020-06-01", "2021-06-01"]),
+    })
+    eos_df = pd.DataFrame({"mnpaid": ["P1"], "eosdat": [pd.NaT], "dthdat": [pd.NaT]})
+    elig_df = pd.DataFrame({"mnpaid": ["P1"], "eligyn": ["Yes"]})
+
+    output = BytesIO()
+    generate_report(icf_df, consents_df, eos_df, elig_df, output)
+
+    table = Document(output).tables[0]
+    assert [(c.cells[1].text, c.cells[2].text) for c in table.rows[1:]] == [
+        ("V2", "2021-06-01"),
+        ("V1", "2020-06-01"),
+    ]